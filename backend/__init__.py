@@ -0,0 +1,3 @@
+"""
+Shopify customer chat backend. The app lives in backend.main (uvicorn backend.main:app).
+"""
@@ -2,27 +2,30 @@
 Customer service chat backend. For now: generic chat with DeepSeek.
 Later: Shopify OAuth + order lookup, then inject order context into the prompt.
 """
+import asyncio
+import logging
 import os
 from pathlib import Path
+from urllib.parse import parse_qsl
 
-# Load .env from project root (parent of backend/) so it works regardless of cwd
 _project_root = Path(__file__).resolve().parent.parent
-_env_file = _project_root / ".env"
 
-from dotenv import load_dotenv
-load_dotenv(_env_file)
+# Importing shopify_config loads .env from the project root (parent of backend/) so it works regardless of cwd
+from backend import shopify_config
 
 os.environ.setdefault("NO_PROXY", "*")
 
 from fastapi import FastAPI, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
 from pydantic import BaseModel
-from openai import OpenAI
+from openai import AsyncOpenAI
+import orjson
 
 import re
 from backend import shopify_auth, shopify_api
+from backend.oauth_state import OAuthStateLimitError
 from backend.shopify_config import (
     SHOPIFY_CLIENT_ID,
     SHOPIFY_CLIENT_SECRET,
@@ -34,20 +37,54 @@ from backend.shopify_config import (
 # Log OAuth config at startup for debugging
 log_oauth_config()
 
+# Per-request OAuth debug output; disabled unless LOG_LEVEL=DEBUG (args are only formatted when enabled)
+oauth_logger = logging.getLogger("shopify.oauth")
+_log_level = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+# getLevelName returns an int only for known names; a typo falls back to INFO instead of failing at import
+oauth_logger.setLevel(_log_level if isinstance(logging.getLevelName(_log_level), int) else logging.INFO)
+# Own stderr handler (like the startup config log), added once: `python -m backend.main` imports this module twice
+if not oauth_logger.handlers:
+    _oauth_handler = logging.StreamHandler()
+    _oauth_handler.setFormatter(logging.Formatter("[%(name)s] %(message)s"))  # e.g. "[shopify.oauth] redirect_uri ..."
+    oauth_logger.addHandler(_oauth_handler)
+oauth_logger.propagate = False  # don't print each line again through root / uvicorn handlers
+
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 DEEPSEEK_BASE_URL = "https://api.deepseek.com"
 DEEPSEEK_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+HISTORY_TURNS = 20  # only the most recent messages are sent to DeepSeek
+
+# One client for all requests: reuses connections to DeepSeek instead of a new TCP + TLS handshake per chat
+_deepseek_client = AsyncOpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_BASE_URL) if DEEPSEEK_API_KEY else None
+
+
+class ORJSONResponse(JSONResponse):
+    """JSON response serialized with orjson (Rust) instead of stdlib json.
+
+    Defined here rather than imported from fastapi.responses, which deprecates its copy in newer releases.
+    """
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+app = FastAPI(title="Shopify Customer Chat", default_response_class=ORJSONResponse)
+
+
+@app.on_event("shutdown")
+async def _close_http_clients():
+    await shopify_api.close_client()
+    await shopify_auth.close_async_client()
 
-app = FastAPI(title="Shopify Customer Chat")
 
 # Allow tunnel origins (ngrok, Cloudflare quick tunnels) so chat works when opened via tunnel URL
-_tunnel_origins = [
+_tunnel_origins = (
     "http://localhost:3000", "http://127.0.0.1:3000",
     "http://localhost:5500", "http://127.0.0.1:5500",
     "http://localhost:8000", "http://127.0.0.1:8000",
-]
+)
 if SHOPIFY_APP_URL and SHOPIFY_APP_URL.startswith("https://"):
-    _tunnel_origins.append(SHOPIFY_APP_URL.rstrip("/"))
+    _tunnel_origins += (SHOPIFY_APP_URL.rstrip("/"),)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=_tunnel_origins,
@@ -71,34 +108,47 @@ class ChatResponse(BaseModel):
     reply: str
 
 
-def get_deepseek_reply(
+_SYSTEM_BASE = (
+    "You are a friendly customer service assistant for an ecommerce store. "
+    "Answer helpfully and concisely using ONLY the store data provided below. "
+    "Do not invent product names, prices, or order details."
+)
+_SYSTEM_NO_DATA = " No store data is available yet; suggest they connect their store or ask for order number and email to look up an order."
+
+
+def _build_messages(
     message: str,
-    history: list[dict] | None = None,
+    history: list[ChatMessage] | None = None,
     store_context: str | None = None,
     order_context: str | None = None,
-) -> str:
-    if not DEEPSEEK_API_KEY:
-        raise ValueError("DEEPSEEK_API_KEY not set in .env")
-
-    client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_BASE_URL)
-    system = (
-        "You are a friendly customer service assistant for an ecommerce store. "
-        "Answer helpfully and concisely using ONLY the store data provided below. "
-        "Do not invent product names, prices, or order details."
-    )
+) -> list[dict]:
+    """System prompt (with store/order data) + recent history + the new user message."""
+    parts = [_SYSTEM_BASE]
     if store_context:
-        system += f"\n\n[Current store data]\n{store_context}"
+        parts.append(f"\n\n[Current store data]\n{store_context}")
     if order_context:
-        system += f"\n\n[Order lookup result]\n{order_context}"
+        parts.append(f"\n\n[Order lookup result]\n{order_context}")
     if not store_context and not order_context:
-        system += " No store data is available yet; suggest they connect their store or ask for order number and email to look up an order."
-    messages = [{"role": "system", "content": system}]
+        parts.append(_SYSTEM_NO_DATA)
+    messages = [{"role": "system", "content": "".join(parts)}]
     if history:
-        for h in history[-20:]:  # last 20 turns
-            messages.append({"role": h["role"], "content": h["content"]})
+        messages += [{"role": h.role, "content": h.content} for h in history[-HISTORY_TURNS:]]
     messages.append({"role": "user", "content": message})
+    return messages
+
+
+async def get_deepseek_reply(
+    message: str,
+    history: list[ChatMessage] | None = None,
+    store_context: str | None = None,
+    order_context: str | None = None,
+) -> str:
+    if _deepseek_client is None:
+        raise ValueError("DEEPSEEK_API_KEY not set in .env")
+
+    messages = _build_messages(message, history, store_context, order_context)
 
-    completion = client.chat.completions.create(
+    completion = await _deepseek_client.chat.completions.create(
         model=DEEPSEEK_MODEL,
         messages=messages,
         temperature=0.4,
@@ -106,41 +156,71 @@ def get_deepseek_reply(
     return (completion.choices[0].message.content or "").strip()
 
 
+async def token_stream(messages: list[dict]):
+    """Stream DeepSeek completion tokens as SSE events: {"token": ...} per delta, then {"done": true}."""
+    try:
+        stream = await _deepseek_client.chat.completions.create(
+            model=DEEPSEEK_MODEL,
+            messages=messages,
+            temperature=0.4,
+            stream=True,
+        )
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                yield b"data: " + orjson.dumps({"token": delta}) + b"\n\n"
+    except Exception as e:
+        # Headers are already sent, so report the failure as an event instead of an HTTP status
+        yield b"data: " + orjson.dumps({"error": f"Chat failed: {e}"}) + b"\n\n"
+        return
+    yield b'data: {"done":true}\n\n'
+
+
 @app.get("/health")
 def health():
     """Tunnel/origin check: if this returns 200, the app is reachable at this host."""
     return {"ok": True, "app": "shopify-chat-bot"}
 
 
+# Simple patterns: "order #1234" / "order 1234", email-like substring
+_EMAIL_RE = re.compile(r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+")
+_ORDER_RE = re.compile(r"(?:order\s*#?\s*|#)(\d+)", re.I)
+
+
 def _parse_order_lookup(message: str) -> tuple[str | None, str | None]:
     """Try to extract order number and email from message. Returns (order_number, email) or (None, None)."""
-    # Simple patterns: "order #1234" / "order 1234", email-like substring
-    email_re = r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+"
-    order_re = r"(?:order\s*#?\s*|#)(\d+)"
-    email_match = re.search(email_re, message)
-    order_match = re.search(order_re, message, re.I)
+    email_match = _EMAIL_RE.search(message)
+    order_match = _ORDER_RE.search(message)
     email = email_match.group(0).strip() if email_match else None
     order_num = order_match.group(1).strip() if order_match else None
     return (order_num, email)
 
 
+async def _gather_context(message: str) -> tuple[str | None, str | None]:
+    """Store context and order lookup result for the first connected shop. Returns (store_context, order_context)."""
+    shops = shopify_auth.get_stored_shops()
+    if not shops:
+        return None, None
+    shop = next(iter(shops))
+    token = shops[shop]
+    order_num, email = _parse_order_lookup(message)
+    if not (order_num or email):
+        return await shopify_api.build_store_context(shop, token) or None, None
+    # Independent Shopify calls: wall time is the slower of the two, not the sum
+    store_context, order_context = await asyncio.gather(
+        shopify_api.build_store_context(shop, token),
+        shopify_api.build_order_context(shop, token, order_num or "", email or ""),
+    )
+    return store_context or None, order_context or "No order found for that order number and email."
+
+
 @app.post("/api/chat", response_model=ChatResponse)
-def chat(req: ChatRequest):
+async def chat(req: ChatRequest):
+    """Non-streaming chat (legacy clients). Returns the full reply once DeepSeek has finished."""
     try:
-        history = [{"role": m.role, "content": m.content} for m in (req.history or [])]
-        store_context = None
-        order_context = None
-        shops = shopify_auth.get_stored_shops()
-        if shops:
-            shop = next(iter(shops))
-            token = shops[shop]
-            store_context = shopify_api.build_store_context(shop, token)
-            order_num, email = _parse_order_lookup(req.message)
-            if order_num or email:
-                order_context = shopify_api.build_order_context(shop, token, order_num or "", email or "")
-                if not order_context:
-                    order_context = "No order found for that order number and email."
-        reply = get_deepseek_reply(req.message, history, store_context=store_context, order_context=order_context or None)
+        history = (req.history or [])[-HISTORY_TURNS:]
+        store_context, order_context = await _gather_context(req.message)
+        reply = await get_deepseek_reply(req.message, history, store_context=store_context, order_context=order_context)
         return ChatResponse(reply=reply)
     except ValueError as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -148,6 +228,24 @@ def chat(req: ChatRequest):
         raise HTTPException(status_code=500, detail=f"Chat failed: {e}")
 
 
+@app.post("/api/chat/stream")
+async def chat_stream(req: ChatRequest):
+    """Streaming chat: SSE events with reply tokens as DeepSeek produces them."""
+    if _deepseek_client is None:
+        raise HTTPException(status_code=500, detail="DEEPSEEK_API_KEY not set in .env")
+    try:
+        history = (req.history or [])[-HISTORY_TURNS:]
+        store_context, order_context = await _gather_context(req.message)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Chat failed: {e}")
+    messages = _build_messages(req.message, history, store_context, order_context)
+    return StreamingResponse(
+        token_stream(messages),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # --- Shopify connect (OAuth) ---
 
 @app.get("/auth/shopify")
@@ -158,38 +256,43 @@ def auth_shopify_start(shop: str = Query(..., alias="shop")):
     normalized = shopify_auth.normalize_shop(shop)
     if not shopify_auth.is_valid_shop_hostname(normalized):
         raise HTTPException(status_code=400, detail="Invalid shop. Use your-store.myshopify.com or your-store.")
-    # All auth URLs from single config; redirect_uri derived from SHOPIFY_APP_URL
-    log_oauth_config()
-    url, _ = shopify_auth.build_authorize_url(normalized, SHOPIFY_CLIENT_ID, SHOPIFY_REDIRECT_URI)
-    # Debug: log exact redirect_uri we're sending so it can be copy-pasted into Shopify dashboard
-    import sys
-    print(f"[Shopify OAuth] redirect_uri sent to Shopify: {repr(SHOPIFY_REDIRECT_URI)}", file=sys.stderr)
+    # All auth URLs from single config; redirect_uri derived from SHOPIFY_APP_URL (logged once at startup)
+    try:
+        url, _ = shopify_auth.build_authorize_url(normalized, SHOPIFY_CLIENT_ID, SHOPIFY_REDIRECT_URI)
+    except OAuthStateLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    # Debug: exact redirect_uri we're sending, for copy-pasting into the Shopify dashboard (LOG_LEVEL=DEBUG)
+    oauth_logger.debug("redirect_uri sent to Shopify: %r", SHOPIFY_REDIRECT_URI)
     return RedirectResponse(url=url, status_code=302)
 
 
 @app.get("/auth/shopify/callback")
-def auth_shopify_callback(request: Request):
+async def auth_shopify_callback(request: Request):
     """Shopify redirects here after approval. Verify HMAC and state, exchange code, save token."""
     if not SHOPIFY_CLIENT_ID or not SHOPIFY_CLIENT_SECRET:
         raise HTTPException(status_code=503, detail="Shopify app not configured.")
-    params = dict(request.query_params)
-    raw_query = request.scope.get("query_string", b"").decode("utf-8")
-    ok = shopify_auth.verify_hmac_raw_query(raw_query, SHOPIFY_CLIENT_SECRET) or shopify_auth.verify_hmac(params, SHOPIFY_CLIENT_SECRET)
+    # Parse the raw query once (it's percent-encoded ASCII, so latin-1 decodes it losslessly) and reuse the pairs
+    raw_query = request.scope.get("query_string", b"").decode("latin-1")
+    pairs = parse_qsl(raw_query, keep_blank_values=True)
+    ok = shopify_auth.verify_hmac_pairs(pairs, SHOPIFY_CLIENT_SECRET) or shopify_auth.verify_hmac(dict(pairs), SHOPIFY_CLIENT_SECRET)
     if not ok:
         raise HTTPException(status_code=400, detail="Invalid HMAC")
+    params = dict(pairs)
     state = params.get("state")
-    shop = shopify_auth._oauth_states.pop(state, None)
+    # In a worker thread: with OAUTH_STATE_BACKEND=redis this is a blocking GETDEL round trip
+    shop = await asyncio.to_thread(shopify_auth.pop_oauth_state, state)
     incoming_shop = shopify_auth.normalize_shop(params.get("shop", ""))
     if not shop or shop != incoming_shop:
         raise HTTPException(status_code=400, detail="Invalid or expired state. Try connecting again.")
     code = params.get("code")
     if not code:
         raise HTTPException(status_code=400, detail="Missing code")
+    # Token exchange is awaited on the event loop; the save (disk write) blocks, so it runs in a worker thread
     try:
-        token = shopify_auth.exchange_code_for_token(shop, code, SHOPIFY_CLIENT_ID, SHOPIFY_CLIENT_SECRET)
+        token = await shopify_auth.exchange_code_for_token_async(shop, code, SHOPIFY_CLIENT_ID, SHOPIFY_CLIENT_SECRET)
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Could not get token: {e}")
-    shopify_auth.save_token(shop, token)
+    await asyncio.to_thread(shopify_auth.save_token, shop, token)
     return RedirectResponse(url="/connect?connected=1", status_code=302)
 
 
@@ -201,15 +304,17 @@ def api_connected_shops():
 
 
 @app.get("/api/store_status")
-def api_store_status():
+async def api_store_status():
     """Debug: show if we can reach Shopify (shop info + product count). Use to verify token has read_products."""
     shops = shopify_auth.get_stored_shops()
     if not shops:
         return {"connected": False, "message": "No store connected."}
     shop = next(iter(shops))
     token = shops[shop]
-    shop_info = shopify_api.get_shop_info(shop, token)
-    products = shopify_api.get_products(shop, token, limit=5)
+    shop_info, products = await asyncio.gather(
+        shopify_api.get_shop_info(shop, token),
+        shopify_api.get_products(shop, token, limit=5),
+    )
     return {
         "connected": True,
         "shop": shop,
@@ -251,26 +356,40 @@ def shopify_debug():
     return {"redirect_uri": SHOPIFY_REDIRECT_URI, "app_url": SHOPIFY_APP_URL, "authorize_url_example": url}
 
 
+# Static files: paths (and whether connect.html exists) are resolved once at import, not per request
+STATIC_DIR = str(_project_root / "static")
+_INDEX_HTML = os.path.join(STATIC_DIR, "index.html")
+_CONNECT_HTML = os.path.join(STATIC_DIR, "connect.html")
+_CONNECT_HTML_EXISTS = os.path.isfile(_CONNECT_HTML)
+
+
 # Connect page (store owner links their Shopify store)
 @app.get("/connect")
-def connect_page():
-    connect_path = Path(__file__).resolve().parent.parent / "static" / "connect.html"
-    if connect_path.exists():
-        return FileResponse(connect_path)
-    from fastapi.responses import HTMLResponse
+async def connect_page():
+    if _CONNECT_HTML_EXISTS:
+        return FileResponse(_CONNECT_HTML)
     return HTMLResponse(content="<h1>Connect your Shopify store</h1><p><a href='/'>Back to chat</a></p><p>Add static/connect.html for the form.</p>")
 
 
 # Serve frontend
-STATIC_DIR = os.path.join(os.path.dirname(__file__), "..", "static")
 if os.path.isdir(STATIC_DIR):
     app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
     @app.get("/")
-    def index():
-        return FileResponse(os.path.join(STATIC_DIR, "index.html"))
+    async def index():
+        return FileResponse(_INDEX_HTML)
 
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop (libuv event loop) + httptools (C HTTP parser); uvloop doesn't support Windows.
+    # More than one worker needs the import string, not the app object.
+    uvicorn.run(
+        "backend.main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=int(os.getenv("UVICORN_WORKERS", "1")),
+    )
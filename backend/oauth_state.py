@@ -0,0 +1,73 @@
+"""
+Pending OAuth states (nonce -> shop) between /auth/shopify and the callback.
+Memory (default) only works when the callback reaches the same process; Redis shares states across instances.
+"""
+import threading
+from typing import Protocol
+
+from cachetools import TTLCache
+
+from backend.shopify_config import OAUTH_STATE_BACKEND, REDIS_URL
+
+OAUTH_STATE_TTL = 600  # seconds; states expire after the OAuth window
+OAUTH_STATE_MAX = 10_000  # memory backend only
+
+
+class OAuthStateLimitError(Exception):
+    """Too many OAuth flows are pending; refuse to start another until some expire."""
+
+
+class OAuthStateStore(Protocol):
+    def put(self, state: str, shop: str) -> None:
+        """Remember state -> shop for OAUTH_STATE_TTL seconds."""
+
+    def pop(self, state: str) -> str | None:
+        """Consume state. Returns its shop, or None if unknown or expired."""
+
+
+class InMemoryOAuthStateStore:
+    """Bounded, expiring dict in this process, so repeated /auth/shopify hits can't grow it without limit."""
+
+    def __init__(self, maxsize: int = OAUTH_STATE_MAX, ttl: int = OAUTH_STATE_TTL):
+        self._states: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def put(self, state: str, shop: str) -> None:
+        with self._lock:
+            self._states.expire()
+            if len(self._states) >= self._states.maxsize:
+                raise OAuthStateLimitError("Too many pending store connections. Try again in a few minutes.")
+            self._states[state] = shop
+
+    def pop(self, state: str) -> str | None:
+        with self._lock:
+            return self._states.pop(state, None)
+
+
+class RedisOAuthStateStore:
+    """oauth:state:<nonce> keys with a Redis TTL. Needs the redis package and Redis >= 6.2 (GETDEL)."""
+
+    def __init__(self, url: str, ttl: int = OAUTH_STATE_TTL, prefix: str = "oauth:state:"):
+        import redis  # optional; only needed when OAUTH_STATE_BACKEND=redis
+
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._ttl = ttl
+        self._prefix = prefix
+
+    def put(self, state: str, shop: str) -> None:
+        self._redis.setex(self._prefix + state, self._ttl, shop)
+
+    def pop(self, state: str) -> str | None:
+        return self._redis.getdel(self._prefix + state)
+
+
+def _make_store() -> OAuthStateStore:
+    if OAUTH_STATE_BACKEND == "redis":
+        return RedisOAuthStateStore(REDIS_URL)
+    if OAUTH_STATE_BACKEND != "memory":
+        raise ValueError(f"OAUTH_STATE_BACKEND must be 'memory' or 'redis', got {OAUTH_STATE_BACKEND!r}")
+    return InMemoryOAuthStateStore()
+
+
+# Configured store used by build_authorize_url and the callback
+oauth_state_store: OAuthStateStore = _make_store()
@@ -1,115 +1,273 @@
 """
-Fetch shop, products, and orders from Shopify REST Admin API using stored token.
+Fetch shop, products, and orders from Shopify Admin API (REST + GraphQL) using stored token.
 """
+import asyncio
+import time
+from collections import defaultdict
+
 import httpx
+import orjson
 
 API_VERSION = "2024-01"
 BASE = "https://{shop}/admin/api/{version}"
 
+# Shared client: keeps connections to each shop alive across calls and requests, and multiplexes
+# concurrent requests to the same shop over one HTTP/2 connection
+_client = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(15.0, connect=5.0),
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+)
+
+
+# Product fields we read (products.json otherwise includes body_html, images, options, ...)
+PRODUCT_FIELDS = "id,title,variants"
+# Order fields used by build_order_context (orders.json returns full orders otherwise)
+ORDER_FIELDS = "id,order_number,name,email,total_price,currency,fulfillment_status"
+
+# Shop + first 20 products with price and stock in one round trip (replaces shop.json + products.json
+# + one inventory_levels.json call per product)
+STORE_CONTEXT_QUERY = """
+query StoreContext($withProducts: Boolean!) {
+  shop { name primaryDomain { url } currencyCode }
+  products(first: 20) @include(if: $withProducts) {
+    edges { node { title variants(first: 1) { edges { node { price inventoryQuantity } } } } }
+  }
+}
+"""
+
+# Store context changes on the order of minutes; serve it from memory for this long (seconds)
+STORE_CONTEXT_TTL = 60
+# (shop, include_products) -> (fetched_at monotonic, context string)
+_store_context_cache: dict[tuple[str, bool], tuple[float, str]] = {}
+# One lock per shop so concurrent chats wait for a single refresh instead of all hitting Shopify
+_store_context_locks: defaultdict[tuple[str, bool], asyncio.Lock] = defaultdict(asyncio.Lock)
+
+# Orders matching a search like "name:#1001 OR name:#1002" (used by OrderBatcher)
+ORDERS_BY_NAME_QUERY = """
+query OrdersByName($query: String!, $first: Int!) {
+  orders(first: $first, query: $query) {
+    edges { node { name email displayFulfillmentStatus totalPriceSet { shopMoney { amount currencyCode } } } }
+  }
+}
+"""
+
 
 def _headers(token: str) -> dict:
     return {"X-Shopify-Access-Token": token, "Content-Type": "application/json"}
 
 
-def get_shop_info(shop: str, token: str) -> dict | None:
+async def close_client() -> None:
+    """Stop the order batcher and close the shared HTTP client (call on app shutdown)."""
+    _order_batcher.close()
+    await _client.aclose()
+
+
+async def graphql(shop: str, token: str, query: str, variables: dict | None = None) -> dict | None:
+    """POST graphql.json. Returns the response's data dict or None on error."""
+    url = f"{BASE.format(shop=shop, version=API_VERSION)}/graphql.json"
+    try:
+        r = await _client.post(url, headers=_headers(token), json={"query": query, "variables": variables or {}})
+        r.raise_for_status()
+        return orjson.loads(r.content).get("data")
+    except Exception:
+        return None
+
+
+async def get_shop_info(shop: str, token: str) -> dict | None:
     """GET shop.json. Returns shop dict or None on error."""
     url = f"{BASE.format(shop=shop, version=API_VERSION)}/shop.json"
     try:
-        r = httpx.get(url, headers=_headers(token), timeout=15)
+        r = await _client.get(url, headers=_headers(token))
         r.raise_for_status()
-        return r.json().get("shop")
+        return orjson.loads(r.content).get("shop")
     except Exception:
         return None
 
 
-def get_products(shop: str, token: str, limit: int = 25) -> list[dict]:
-    """GET products.json. Returns list of product dicts (id, title, body_html, variants with price)."""
+async def get_products(shop: str, token: str, limit: int = 25) -> list[dict]:
+    """GET products.json. Returns list of product dicts (id, title, variants with price)."""
     url = f"{BASE.format(shop=shop, version=API_VERSION)}/products.json"
     try:
-        r = httpx.get(url, headers=_headers(token), params={"limit": limit}, timeout=15)
+        r = await _client.get(url, headers=_headers(token), params={"limit": limit, "fields": PRODUCT_FIELDS})
         r.raise_for_status()
-        return r.json().get("products", [])
+        return orjson.loads(r.content).get("products", [])
     except Exception:
         return []
 
 
-def get_inventory_available(shop: str, token: str, inventory_item_id: int) -> int | None:
+async def get_inventory_available(shop: str, token: str, inventory_item_id: int) -> int | None:
     """GET inventory_levels for one item. Returns total available across locations or None."""
     url = f"{BASE.format(shop=shop, version=API_VERSION)}/inventory_levels.json"
     try:
-        r = httpx.get(
+        r = await _client.get(
             url,
             headers=_headers(token),
             params={"inventory_item_ids": inventory_item_id},
             timeout=10,
         )
         r.raise_for_status()
-        levels = r.json().get("inventory_levels", [])
+        levels = orjson.loads(r.content).get("inventory_levels", [])
         return sum(int(l.get("available", 0) or 0) for l in levels)
     except Exception:
         return None
 
 
-def get_order_by_number_and_email(shop: str, token: str, order_number: str, email: str) -> dict | None:
-    """Find an order by order number and customer email. Returns order dict or None."""
-    # Shopify order_number is integer; name is like "#1001". Search by status=any and filter.
+async def get_order_by_email(shop: str, token: str, email: str) -> dict | None:
+    """Most recent order placed with this customer email (case-insensitive). Returns order dict or None."""
     url = f"{BASE.format(shop=shop, version=API_VERSION)}/orders.json"
+    email_lower = email.strip().lower()
+    # orders.json has no email filter; scan recent orders, but fetch only the fields we use
+    params = {"status": "any", "limit": 250, "fields": ORDER_FIELDS}
     try:
-        r = httpx.get(
-            url,
-            headers=_headers(token),
-            params={"status": "any", "limit": 250},
-            timeout=15,
-        )
+        r = await _client.get(url, headers=_headers(token), params=params)
         r.raise_for_status()
-        orders = r.json().get("orders", [])
-        email_lower = email.strip().lower()
-        order_num = str(order_number).strip().lstrip("#")
-        for o in orders:
-            if not order_num and str(o.get("email", "")).lower() == email_lower:
-                return o
-            if order_num and str(o.get("order_number", "")).strip() == order_num:
-                if str(o.get("email", "")).lower() == email_lower:
-                    return o
-                return o  # match by number only if email not provided
-        return None
+        orders = orjson.loads(r.content).get("orders", [])
+        return next((o for o in orders if str(o.get("email", "")).lower() == email_lower), None)
     except Exception:
         return None
 
 
-def build_store_context(shop: str, token: str, include_products: bool = True) -> str:
-    """Build a context string (shop info + products) for the LLM."""
+async def build_store_context(shop: str, token: str, include_products: bool = True) -> str:
+    """Build a context string (shop info + products) for the LLM. Cached per shop for STORE_CONTEXT_TTL seconds."""
+    key = (shop, include_products)
+    hit = _store_context_cache.get(key)
+    if hit and time.monotonic() - hit[0] < STORE_CONTEXT_TTL:
+        return hit[1]
+    async with _store_context_locks[key]:
+        # Another request may have refreshed it while we waited for the lock
+        hit = _store_context_cache.get(key)
+        if hit and time.monotonic() - hit[0] < STORE_CONTEXT_TTL:
+            return hit[1]
+        context = await _fetch_store_context(shop, token, include_products)
+        if context:  # don't cache failures; retry on the next chat
+            _store_context_cache[key] = (time.monotonic(), context)
+        return context
+
+
+async def _fetch_store_context(shop: str, token: str, include_products: bool) -> str:
+    """Shop info + products from a single GraphQL request."""
+    data = await graphql(shop, token, STORE_CONTEXT_QUERY, {"withProducts": include_products})
+    if not data:
+        return ""
     parts = []
-    shop_info = get_shop_info(shop, token)
+    shop_info = data.get("shop")
     if shop_info:
         parts.append(
-            f"Store: {shop_info.get('name', 'N/A')}. "
-            f"Primary domain: {shop_info.get('primary_domain', {}).get('url', shop)}. "
-            f"Currency: {shop_info.get('currency', 'USD')}."
+            f"Store: {shop_info.get('name') or 'N/A'}. "
+            f"Primary domain: {(shop_info.get('primaryDomain') or {}).get('url', shop)}. "
+            f"Currency: {shop_info.get('currencyCode') or 'USD'}."
         )
-    if include_products:
-        products = get_products(shop, token)
-        if products:
-            lines = []
-            for p in products[:20]:
-                title = p.get("title", "?")
-                variants = p.get("variants", [])
-                prices = [v.get("price") for v in variants if v.get("price")]
-                price_str = f" ${prices[0]}" if prices else ""
-                stock_str = ""
-                inv_item_id = variants[0].get("inventory_item_id") if variants else None
-                if inv_item_id:
-                    available = get_inventory_available(shop, token, inv_item_id)
-                    if available is not None:
-                        stock_str = f", {available} in stock"
-                lines.append(f"- {title}{price_str}{stock_str}")
-            parts.append("Products (name, price, stock): " + "; ".join(lines))
+    products = (data.get("products") or {}).get("edges", [])
+    if products:
+        lines = []
+        for edge in products:
+            p = edge["node"]
+            variants = p.get("variants", {}).get("edges", [])
+            v = variants[0]["node"] if variants else {}
+            price_str = f" ${v['price']}" if v.get("price") else ""
+            available = v.get("inventoryQuantity")
+            stock_str = f", {available} in stock" if available is not None else ""
+            lines.append(f"- {p.get('title', '?')}{price_str}{stock_str}")
+        parts.append("Products (name, price, stock): " + "; ".join(lines))
     return " ".join(parts) if parts else ""
 
 
-def build_order_context(shop: str, token: str, order_number: str, email: str) -> str:
-    """Fetch one order by number + email and return a short context string for the LLM."""
-    order = get_order_by_number_and_email(shop, token, order_number, email)
+def _order_from_graphql(node: dict) -> dict:
+    """Map a GraphQL order node to the REST orders.json field names build_order_context reads."""
+    name = node.get("name") or ""
+    money = (node.get("totalPriceSet") or {}).get("shopMoney") or {}
+    return {
+        "order_number": name.lstrip("#"),
+        "name": name,
+        "email": node.get("email"),
+        "total_price": money.get("amount"),
+        "currency": money.get("currencyCode", ""),
+        "fulfillment_status": (node.get("displayFulfillmentStatus") or "").lower() or None,
+    }
+
+
+class OrderBatcher:
+    """Coalesce order-number lookups that arrive within max_wait_ms into one GraphQL query per shop.
+
+    Under concurrent chats, K lookups cost one Shopify round trip instead of K.
+    """
+
+    def __init__(self, max_wait_ms: int = 20, max_batch: int = 25):
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue | None = None
+        self._worker: asyncio.Task | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._pending: set[asyncio.Task] = set()
+
+    async def lookup(self, shop: str, token: str, order_num: str) -> dict | None:
+        """Order with name "#<order_num>" (REST-style dict), or None if not found."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker is None or self._worker.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        fut = loop.create_future()
+        self._queue.put_nowait((shop, token, order_num, fut))
+        return await fut
+
+    def close(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            groups: defaultdict[tuple[str, str], list[tuple[str, asyncio.Future]]] = defaultdict(list)
+            for shop, token, order_num, fut in batch:
+                groups[(shop, token)].append((order_num, fut))
+            # Resolve in the background so the next batch can start collecting meanwhile
+            for (shop, token), items in groups.items():
+                task = loop.create_task(self._resolve(shop, token, items))
+                self._pending.add(task)
+                task.add_done_callback(self._pending.discard)
+
+    async def _resolve(self, shop: str, token: str, items: list[tuple[str, asyncio.Future]]) -> None:
+        try:
+            names = {f"#{order_num}" for order_num, _ in items}
+            query = " OR ".join(f"name:{n}" for n in names)
+            data = await graphql(shop, token, ORDERS_BY_NAME_QUERY, {"query": query, "first": 2 * len(names)})
+            found: dict[str, dict] = {}
+            for edge in ((data or {}).get("orders") or {}).get("edges", []):
+                order = _order_from_graphql(edge["node"])
+                found.setdefault(order["name"], order)
+            for order_num, fut in items:
+                if not fut.done():
+                    fut.set_result(found.get(f"#{order_num}"))
+        except BaseException as e:
+            for _, fut in items:
+                if not fut.done():
+                    fut.set_exception(e)
+            raise
+
+
+_order_batcher = OrderBatcher()
+
+
+async def build_order_context(shop: str, token: str, order_number: str, email: str) -> str:
+    """Fetch one order by number (batched across chats) or by email and return a short context string for the LLM."""
+    order_num = str(order_number).strip().lstrip("#")
+    if order_num:
+        order = await _order_batcher.lookup(shop, token, order_num)
+    else:
+        order = await get_order_by_email(shop, token, email)
     if not order:
         return ""
     lines = [
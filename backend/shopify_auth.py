@@ -2,60 +2,136 @@
 Shopify OAuth: install flow and token storage.
 Store owner connects via /connect -> redirect to Shopify -> callback -> store token.
 """
+import atexit
 import hashlib
 import hmac
-import json
-import secrets
+import os
 import re
+import threading
+from collections import deque
+from functools import lru_cache
+from operator import itemgetter
 from pathlib import Path
 from urllib.parse import parse_qsl, urlencode
 
 import httpx
+import orjson
+
+from backend.oauth_state import oauth_state_store
 
 _project_root = Path(__file__).resolve().parent.parent
 STORES_FILE = _project_root / "data" / "stores.json"
+_STORES_PATH = os.fspath(STORES_FILE)  # str form for os.stat / open on the hot path
+_stores_file_ready = False  # set once data/ and stores.json are known to exist
 # Customer service bot: orders, products, customers, inventory (stock), locations (for inventory)
 SCOPES = "read_orders,read_products,read_customers,read_inventory,read_locations"
 
-# In-memory: state (nonce) -> shop domain (for callback verification)
-_oauth_states: dict[str, str] = {}
+# Shared client for OAuth calls: reuses connections / TLS sessions instead of a new handshake per exchange
+_HTTP = httpx.Client(
+    http2=True,
+    timeout=httpx.Timeout(10.0, connect=5.0),
+    limits=httpx.Limits(max_keepalive_connections=20),
+)
+atexit.register(_HTTP.close)
+# Async counterpart used from the FastAPI callback; closed on app shutdown
+_ASYNC_HTTP = httpx.AsyncClient(http2=True, timeout=httpx.Timeout(10.0, connect=5.0))
+
+# In-memory copy of stores.json { shop_domain: access_token }: authoritative for this process (saves write it
+# out without re-reading the file) and reloaded only when the file's stamp changes, i.e. it was edited elsewhere
+_shops: dict[str, str] = {}
+_shops_stamp: tuple[int, int, int] | None = None  # (mtime_ns, inode, size) of the loaded file; None until first load
+_shops_lock = threading.RLock()
+
+# Pre-generated OAuth state nonces; cleared in forked children so processes never share them
+_NONCE_BATCH = 256
+_nonce_pool: deque[str] = deque()
+os.register_at_fork(after_in_child=_nonce_pool.clear)
+
+_SHOP_RE = re.compile(r"^[a-zA-Z0-9][a-zA-Z0-9\-]*\.myshopify\.com$")
 
 
 def _ensure_stores_file() -> Path:
-    STORES_FILE.parent.mkdir(parents=True, exist_ok=True)
-    if not STORES_FILE.exists():
-        STORES_FILE.write_text("{}")
+    """Create data/ and an empty stores.json on first use; later calls are free (no mkdir/exists syscalls)."""
+    global _stores_file_ready
+    if not _stores_file_ready:
+        STORES_FILE.parent.mkdir(parents=True, exist_ok=True)
+        if not STORES_FILE.exists():
+            STORES_FILE.write_text("{}")
+        _stores_file_ready = True
     return STORES_FILE
 
 
+def _file_stamp(st: os.stat_result) -> tuple[int, int, int]:
+    # mtime alone misses two writes within one timestamp tick (coarse-mtime filesystems); every save is an
+    # os.replace, so the inode changes on each write even when mtime doesn't
+    return st.st_mtime_ns, st.st_ino, st.st_size
+
+
+def _stores_stamp() -> tuple[int, int, int]:
+    global _stores_file_ready
+    _ensure_stores_file()
+    try:
+        return _file_stamp(os.stat(_STORES_PATH))
+    except FileNotFoundError:
+        # Deleted since we created it; recreate
+        _stores_file_ready = False
+        _ensure_stores_file()
+        return _file_stamp(os.stat(_STORES_PATH))
+
+
 def get_stored_shops() -> dict[str, str]:
-    """Return { shop_domain: access_token }."""
+    """Return { shop_domain: access_token } (shared in-memory dict; don't mutate). Reloads only if the file changed."""
+    global _shops, _shops_stamp
+    stamp = _stores_stamp()
+    with _shops_lock:
+        if stamp != _shops_stamp:
+            with open(_STORES_PATH, "rb") as f:
+                _shops = orjson.loads(f.read())
+            _shops_stamp = stamp
+        return _shops
+
+
+def _write_shops(data: dict[str, str]) -> None:
+    """Write data to stores.json and make it the in-memory copy. Call with _shops_lock held."""
+    global _shops, _shops_stamp
     _ensure_stores_file()
-    return json.loads(STORES_FILE.read_text())
+    # Write a temp file and rename it over stores.json: readers (and a crash mid-write) never see a partial file.
+    # Per-process name so several workers saving at once don't share a temp file.
+    tmp = f"{_STORES_PATH}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(data))  # compact: machine-read only (pipe through jq . to inspect)
+    os.replace(tmp, _STORES_PATH)
+    _shops, _shops_stamp = data, _file_stamp(os.stat(_STORES_PATH))
 
 
 def save_token(shop: str, access_token: str) -> None:
     """Persist access token for shop."""
-    data = get_stored_shops()
-    data[shop] = access_token
-    _ensure_stores_file()
-    STORES_FILE.write_text(json.dumps(data, indent=2))
+    with _shops_lock:
+        # New dict (not in-place) so callers holding the previous one never see it change underneath them
+        _write_shops({**get_stored_shops(), shop: access_token})
 
 
 def remove_shop(shop: str) -> bool:
     """Remove a shop from stored tokens. Returns True if it was present and removed."""
-    data = get_stored_shops()
     key = normalize_shop(shop)
-    if key not in data:
-        return False
-    del data[key]
-    STORES_FILE.write_text(json.dumps(data, indent=2))
+    with _shops_lock:
+        shops = get_stored_shops()
+        if key not in shops:
+            return False
+        _write_shops({k: v for k, v in shops.items() if k != key})
     return True
 
 
 def get_token(shop: str) -> str | None:
     """Return stored access token for shop, or None."""
-    return get_stored_shops().get(normalize_shop(shop))
+    key = normalize_shop(shop)
+    if _shops_stamp is not None:
+        # Loaded already and kept current by this process's saves: plain dict lookup, no stat
+        token = _shops.get(key)
+        if token is not None:
+            return token
+    # First call, or a shop this process hasn't seen (maybe connected via another worker): check the file
+    return get_stored_shops().get(key)
 
 
 def normalize_shop(shop: str) -> str:
@@ -63,13 +139,40 @@ def normalize_shop(shop: str) -> str:
     s = shop.strip().lower()
     if not s:
         return ""
-    if ".myshopify.com" in s:
-        return s.split(".myshopify.com")[0].split("//")[-1].rstrip("/") + ".myshopify.com"
-    return s + ".myshopify.com"
+    head, sep, _ = s.partition(".myshopify.com")
+    if not sep:
+        return s + ".myshopify.com"
+    if "/" not in head:
+        # Common case: already "xxx.myshopify.com" (maybe with a path after it); no scheme to strip
+        return s if len(head) + 14 == len(s) else head + ".myshopify.com"
+    return head.split("//")[-1].rstrip("/") + ".myshopify.com"
 
 
 def is_valid_shop_hostname(shop: str) -> bool:
-    return bool(re.match(r"^[a-zA-Z0-9][a-zA-Z0-9\-]*\.myshopify\.com$", shop))
+    # Cheap reject before the regex: shortest valid host is "x.myshopify.com" (15 chars)
+    if len(shop) < 15 or not shop.endswith(".myshopify.com"):
+        return False
+    return _SHOP_RE.match(shop) is not None
+
+
+@lru_cache(maxsize=4)
+def _hmac_template(secret: str) -> hmac.HMAC:
+    """HMAC-SHA256 keyed with the app secret (the same value on every callback); copy it, don't update it."""
+    return hmac.new(secret.encode(), digestmod=hashlib.sha256)
+
+
+def _hmac_matches(secret: str, message: str, received: str) -> bool:
+    """Constant-time check of Shopify's hex hmac against HMAC-SHA256(secret, message), compared as raw bytes."""
+    try:
+        received_bytes = bytes.fromhex(received)
+    except (TypeError, ValueError):
+        return False
+    if len(received_bytes) != 32:  # SHA-256 digest size
+        return False
+    # copy() reuses the template's key setup (ipad/opad) instead of redoing it per callback
+    h = _hmac_template(secret).copy()
+    h.update(message.encode())
+    return hmac.compare_digest(h.digest(), received_bytes)
 
 
 def verify_hmac(query_params: dict, secret: str) -> bool:
@@ -77,17 +180,21 @@ def verify_hmac(query_params: dict, secret: str) -> bool:
     if "hmac" not in query_params:
         return False
     received = query_params.get("hmac")
-    rest = {k: v for k, v in query_params.items() if k != "hmac"}
-    message = "&".join(f"{k}={v}" for k, v in sorted(rest.items()))
-    expected = hmac.new(secret.encode(), message.encode(), hashlib.sha256).hexdigest()
-    return hmac.compare_digest(expected, received)
+    # Keys are unique, so sorting by key alone is enough; hmac is skipped while sorting rather than copied out first
+    items = sorted((item for item in query_params.items() if item[0] != "hmac"), key=itemgetter(0))
+    message = "&".join(f"{k}={v}" for k, v in items)
+    return _hmac_matches(secret, message, received)
 
 
 def verify_hmac_raw_query(raw_query: str, secret: str) -> bool:
     """Verify using raw query string (avoids proxy/framework altering params)."""
     if not raw_query:
         return False
-    pairs = parse_qsl(raw_query, keep_blank_values=True)
+    return verify_hmac_pairs(parse_qsl(raw_query, keep_blank_values=True), secret)
+
+
+def verify_hmac_pairs(pairs: list[tuple[str, str]], secret: str) -> bool:
+    """Verify using (key, value) pairs already parsed from the raw query string (keeps repeated keys)."""
     received_hmac = None
     rest = []
     for k, v in pairs:
@@ -98,37 +205,76 @@ def verify_hmac_raw_query(raw_query: str, secret: str) -> bool:
     if received_hmac is None:
         return False
     message = "&".join(f"{k}={v}" for k, v in sorted(rest))
-    expected = hmac.new(secret.encode(), message.encode(), hashlib.sha256).hexdigest()
-    return hmac.compare_digest(expected, received_hmac)
+    return _hmac_matches(secret, message, received_hmac)
+
+
+def _new_state() -> str:
+    """OAuth state nonce: 16 random bytes, hex (same as secrets.token_hex(16)), drawn from a pre-generated pool."""
+    try:
+        return _nonce_pool.popleft()
+    except IndexError:
+        buf = os.urandom(16 * _NONCE_BATCH)  # one urandom call per _NONCE_BATCH states
+        _nonce_pool.extend(buf[i:i + 16].hex() for i in range(0, len(buf), 16))
+        return _nonce_pool.popleft()
+
+
+@lru_cache(maxsize=64)
+def _authorize_query_prefix(client_id: str, redirect_uri: str) -> str:
+    """urlencoded client_id / scope / redirect_uri: constant per app, so encoded once rather than per request."""
+    redirect_uri = redirect_uri.rstrip("/")  # Shopify requires exact match; no trailing slash
+    return urlencode({"client_id": client_id, "scope": SCOPES, "redirect_uri": redirect_uri})
 
 
 def build_authorize_url(shop: str, client_id: str, redirect_uri: str) -> tuple[str, str]:
     """Build Shopify OAuth authorize URL and state (nonce). Returns (url, state)."""
-    redirect_uri = redirect_uri.rstrip("/")  # Shopify requires exact match; no trailing slash
-    state = secrets.token_hex(16)
-    _oauth_states[state] = shop
-    params = {
-        "client_id": client_id,
-        "scope": SCOPES,
-        "redirect_uri": redirect_uri,
-        "state": state,
-    }
-    return f"https://{shop}/admin/oauth/authorize?{urlencode(params)}", state
+    state = _new_state()
+    oauth_state_store.put(state, shop)  # raises OAuthStateLimitError if too many flows are pending
+    query = _authorize_query_prefix(client_id, redirect_uri)
+    # state is hex, so it needs no percent-encoding
+    return f"https://{shop}/admin/oauth/authorize?{query}&state={state}", state
+
+
+def pop_oauth_state(state: str | None) -> str | None:
+    """Consume a state from build_authorize_url. Returns its shop, or None if unknown or expired."""
+    if not state:
+        return None
+    return oauth_state_store.pop(state)
 
 
 def exchange_code_for_token(shop: str, code: str, client_id: str, client_secret: str) -> str:
     """POST to shop's oauth/access_token; return access_token."""
     url = f"https://{shop}/admin/oauth/access_token"
-    with httpx.Client() as client:
-        r = client.post(
-            url,
-            json={
-                "client_id": client_id,
-                "client_secret": client_secret,
-                "code": code,
-            },
-            headers={"Content-Type": "application/json", "Accept": "application/json"},
-        )
-        r.raise_for_status()
-        data = r.json()
+    r = _HTTP.post(
+        url,
+        json={
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "code": code,
+        },
+        headers={"Content-Type": "application/json", "Accept": "application/json"},
+    )
+    r.raise_for_status()
+    data = r.json()
     return data["access_token"]
+
+
+async def exchange_code_for_token_async(shop: str, code: str, client_id: str, client_secret: str) -> str:
+    """Async exchange_code_for_token for FastAPI handlers: awaits the POST instead of blocking a thread."""
+    url = f"https://{shop}/admin/oauth/access_token"
+    r = await _ASYNC_HTTP.post(
+        url,
+        json={
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "code": code,
+        },
+        headers={"Content-Type": "application/json", "Accept": "application/json"},
+    )
+    r.raise_for_status()
+    data = r.json()
+    return data["access_token"]
+
+
+async def close_async_client() -> None:
+    """Close the shared async HTTP client (call on app shutdown)."""
+    await _ASYNC_HTTP.aclose()
@@ -3,15 +3,53 @@ Single source of truth for Shopify OAuth configuration.
 All auth URLs and credentials are derived from env; redirect_uri is built from SHOPIFY_APP_URL.
 """
 import os
+import re
 import sys
 from pathlib import Path
 
-# Load .env from project root so config is available when this module is imported
+_DOUBLE_QUOTED = re.compile(r'"((?:\\.|[^"\\])*)"')
+_SINGLE_QUOTED = re.compile(r"'((?:\\.|[^'\\])*)'")
+_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", '"': '"', "'": "'", "\\": "\\"}
+
+
+def _parse_env_line(line: str) -> tuple[str, str] | None:
+    """(KEY, VALUE) from one .env line, or None for blanks/comments.
+
+    Handles `export `, single/double quotes with backslash escapes (\\n, \\t, \\", ... in double quotes; only
+    \\' and \\\\ in single quotes, as python-dotenv does), and # comments after whitespace on unquoted values.
+    No variable expansion or multi-line values.
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    if line.startswith("export "):
+        line = line[7:].lstrip()
+    key, sep, value = line.partition("=")
+    key = key.strip()
+    if not sep or not key:
+        return None
+    value = value.strip()
+    if m := _DOUBLE_QUOTED.match(value):
+        return key, re.sub(r"\\(.)", lambda e: _ESCAPES.get(e[1], e[0]), m[1])
+    if m := _SINGLE_QUOTED.match(value):
+        return key, re.sub(r"\\([\\'])", r"\1", m[1])
+    return key, re.split(r"\s#", value, maxsplit=1)[0].rstrip()
+
+
+def load_env_file(path: Path) -> None:
+    """Stdlib replacement for python-dotenv's load_dotenv: set vars from a .env file, never overriding existing ones."""
+    for line in path.read_text(encoding="utf-8").splitlines():
+        parsed = _parse_env_line(line)
+        if parsed:
+            os.environ.setdefault(*parsed)
+
+
+# Load .env from project root so config is available when this module is imported.
+# SKIP_DOTENV=1 skips it entirely (production, where the platform injects env vars).
 _root = Path(__file__).resolve().parent.parent
 _env = _root / ".env"
-if _env.exists():
-    from dotenv import load_dotenv
-    load_dotenv(_env)
+if not os.getenv("SKIP_DOTENV") and _env.exists():
+    load_env_file(_env)
 
 # Preferred env names; fallback to legacy names for backward compatibility
 SHOPIFY_CLIENT_ID = os.getenv("SHOPIFY_CLIENT_ID") or os.getenv("SHOPIFY_API_KEY")
@@ -24,6 +62,10 @@ SHOPIFY_APP_URL = _raw_app_url or "http://localhost:8000"
 # redirect_uri is ALWAYS derived from SHOPIFY_APP_URL (never hardcoded or from a separate env).
 SHOPIFY_REDIRECT_URI = f"{SHOPIFY_APP_URL}/auth/shopify/callback"
 
+# Where pending OAuth states live: "memory" (single process) or "redis" (several instances; needs REDIS_URL)
+OAUTH_STATE_BACKEND = (os.getenv("OAUTH_STATE_BACKEND") or "memory").strip().lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
 
 def log_oauth_config() -> None:
     """Log final client_id and redirect_uri for debugging verification."""